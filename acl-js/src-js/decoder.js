@@ -44,10 +44,11 @@ const importObject = {
   }
 }
 
-function unhex(data) {
-  const bytes = new Uint8Array(data.length / 2)
-  for (let i = 0; i < data.length; i += 2) {
-    bytes[i / 2] = parseInt(data.substr(i, 2), 16)
+function unbase64(data) {
+  const str = atob(data)
+  const bytes = new Uint8Array(str.length)
+  for (let i = 0; i < str.length; ++i) {
+    bytes[i] = str.charCodeAt(i)
   }
   return bytes.buffer
 }
@@ -70,7 +71,7 @@ export class Decoder {
     if (!wasmState.initPromise) {
       // The first time we create a decoder, we load the WASM code and init everything
       const that = this
-      wasmState.initPromise = WebAssembly.instantiate(unhex(wasmBinaryBlob), importObject)
+      wasmState.initPromise = WebAssembly.instantiate(unbase64(wasmBinaryBlob), importObject)
         .then(obj => {
           wasmState.module = obj.module
           wasmState.instance = obj.instance
@@ -41,10 +41,11 @@ const importObject = {
   }
 }
 
-function unhex(data) {
-  const bytes = new Uint8Array(data.length / 2)
-  for (let i = 0; i < data.length; i += 2) {
-    bytes[i / 2] = parseInt(data.substr(i, 2), 16)
+function unbase64(data) {
+  const str = atob(data)
+  const bytes = new Uint8Array(str.length)
+  for (let i = 0; i < str.length; ++i) {
+    bytes[i] = str.charCodeAt(i)
   }
   return bytes.buffer
 }
@@ -63,7 +64,7 @@ export class Encoder {
   constructor() {
     if (!wasmInitPromise) {
       // The first time we create an encoder, we load the WASM code and init everything
-      wasmInitPromise = WebAssembly.instantiate(unhex(wasmBinaryBlob), importObject)
+      wasmInitPromise = WebAssembly.instantiate(unbase64(wasmBinaryBlob), importObject)
         .then(obj => {
           wasmModule = obj.module
           wasmInstance = obj.instance
@@ -25,7 +25,7 @@
 ////////////////////////////////////////////////////////////////////////////////
 // THIS FILE IS AUTOGENERATED
 // See make.py
-// We compile our C++ code to WASM, convert the binary blob to a hex string and store it here.
+// We compile our C++ code to WASM, convert the binary blob to a base64 string and store it here.
 // This makes packaging easier.
 // DO NOT SUBMIT THIS FILE WITH THE BINARY DATA TO GITHUB! It pollutes and inflates
 // the depot size for no good reason.
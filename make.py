@@ -3,14 +3,28 @@
 from __future__ import print_function
 
 import argparse
-import codecs
-import multiprocessing
+import base64
+import concurrent.futures
+import glob
+import hashlib
+import mmap
 import os
 import platform
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+
+# Matches the lines of our generated WASM JS files that we patch after building
+COMPILED_WITH_RE = re.compile(r'([ \t]*// Compiled with )')
+WASM_BINARY_BLOB_RE = re.compile(r'([ \t]*export const wasmBinaryBlob =) "')
+
+# Number of CPUs we are allowed to run on, computed once
+if hasattr(os, 'sched_getaffinity'):
+	NUM_CPUS = len(os.sched_getaffinity(0))
+else:
+	NUM_CPUS = os.cpu_count() or 4
 
 def parse_argv():
 	parser = argparse.ArgumentParser(add_help=False)
@@ -29,82 +43,145 @@ def parse_argv():
 	misc.add_argument('-tests_matching', help='Only run tests whose names match this regex')
 	misc.add_argument('-help', action='help', help='Display this usage information')
 
-	num_threads = multiprocessing.cpu_count()
-	if platform.system() == 'Linux' and sys.version_info >= (3, 4):
-		num_threads = len(os.sched_getaffinity(0))
-	if not num_threads or num_threads == 0:
-		num_threads = 4
-
-	parser.set_defaults(build=False, clean=False, unit_test=False, pack=False, config='Release', num_threads=num_threads, tests_matching='')
+	parser.set_defaults(build=False, clean=False, unit_test=False, pack=False, config='Release', num_threads=NUM_CPUS, tests_matching='')
 
 	args = parser.parse_args()
 
 	return args
 
+def clean_dir(dir_path, executor):
+	dir_name = os.path.basename(dir_path)
+	parent_dir = os.path.dirname(dir_path)
+
+	# Sweep whatever an interrupted clean might have left behind
+	trash_pattern = os.path.join(glob.escape(parent_dir), glob.escape(dir_name) + '.trash.*')
+	futures = [executor.submit(shutil.rmtree, trash_dir) for trash_dir in glob.glob(trash_pattern)]
+
+	if platform.system() == 'Windows':
+		# Renaming fails if something still holds a handle in the directory, delete it in place
+		if os.path.exists(dir_path):
+			shutil.rmtree(dir_path)
+		return futures
+
+	# Move the directory into a unique trash directory so that it can be re-created right away
+	# while the actual deletion happens in the background
+	trash_dir = tempfile.mkdtemp(prefix=dir_name + '.trash.', dir=parent_dir)
+	try:
+		os.replace(dir_path, os.path.join(trash_dir, dir_name))
+	except FileNotFoundError:
+		# Nothing to clean
+		os.rmdir(trash_dir)
+		return futures
+
+	futures.append(executor.submit(shutil.rmtree, trash_dir))
+	return futures
+
 def do_generate_solution(install_dir, args):
 	extra_switches = ['--no-warn-unused-cli']
 	extra_switches.append('-DCMAKE_BUILD_TYPE={}'.format(args.config.upper()))
 
 	# Generate IDE solution
 	print('Generating build files ...')
-	cmake_cmd = 'emcmake cmake .. -DCMAKE_INSTALL_PREFIX="{}" {}'.format(install_dir, ' '.join(extra_switches))
+	cmake_cmd = ['emcmake', 'cmake', '..', '-DCMAKE_INSTALL_PREFIX={}'.format(install_dir)]
+	cmake_cmd.extend(extra_switches)
 
-	result = subprocess.call(cmake_cmd, shell=True)
+	result = subprocess.call(cmake_cmd)
 	if result != 0:
 		print('Failed to generate solution files!')
 		sys.exit(result)
 
-def do_build(install_dir, js_dir, args):
+def patch_wasm_js(js_filename, emcc_version, wasm_data):
+	# The JS file can be several MB once the binary blob is embedded, stream it line by line
+	# and only rewrite the two lines we care about
+	js_file_dir = os.path.dirname(js_filename)
+	dst = tempfile.NamedTemporaryFile('w', dir=js_file_dir, delete=False)
+	tmp_filename = dst.name
+	try:
+		with open(js_filename, 'r') as src, dst:
+			for line in src:
+				compiled_with = COMPILED_WITH_RE.match(line)
+				if compiled_with:
+					dst.write('{}{}\n'.format(compiled_with.group(1), emcc_version))
+					continue
+
+				wasm_blob = WASM_BINARY_BLOB_RE.match(line)
+				if wasm_blob:
+					dst.write('{} "{}"\n'.format(wasm_blob.group(1), wasm_data))
+					continue
+
+				dst.write(line)
+
+		shutil.copymode(js_filename, tmp_filename)
+		os.replace(tmp_filename, js_filename)
+	except BaseException:
+		# Don't leave a stray temporary file in our package sources
+		os.remove(tmp_filename)
+		raise
+
+def get_wasm_js_stamp(js_filename, wasm_hash, emcc_version):
+	# The JS file size and timestamp are included to catch it being reverted or edited
+	js_stat = os.stat(js_filename)
+	return '{}\n{}\n{} {}\n'.format(wasm_hash, emcc_version, js_stat.st_size, js_stat.st_mtime_ns)
+
+def patch_wasm_module(wasm_filename, js_filename, stamp_filename, emcc_version):
+	wasm_data = None
+	with open(wasm_filename, 'rb') as f:
+		# Map the binary instead of reading it to avoid holding an extra copy in memory
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as wasm_binary:
+			wasm_hash = hashlib.sha256(wasm_binary).hexdigest()
+
+			# If nothing changed since we last patched the JS file, we have nothing to do
+			previous_stamp = None
+			try:
+				with open(stamp_filename, 'r') as stamp_file:
+					previous_stamp = stamp_file.read()
+			except FileNotFoundError:
+				# We never patched this module before
+				pass
+
+			if previous_stamp == get_wasm_js_stamp(js_filename, wasm_hash, emcc_version):
+				return
+
+			wasm_data = base64.b64encode(wasm_binary).decode('utf-8')
+
+	patch_wasm_js(js_filename, emcc_version, wasm_data)
+
+	with open(stamp_filename, 'w') as stamp_file:
+		stamp_file.write(get_wasm_js_stamp(js_filename, wasm_hash, emcc_version))
+
+def do_build(build_dir, install_dir, js_dir, args):
 	print('Building ...')
-	cmake_cmd = 'cmake --build .'
+	cmake_cmd = ['cmake', '--build', '.', '--parallel', str(args.num_threads)]
 	if platform.system() == 'Darwin':
-		cmake_cmd += ' --config {} --target install'.format(args.config)
+		cmake_cmd.extend(['--config', args.config, '--target', 'install'])
 	else:
-		cmake_cmd += ' --target install'
+		cmake_cmd.extend(['--target', 'install'])
 
-	result = subprocess.call(cmake_cmd, shell=True)
+	result = subprocess.call(cmake_cmd)
 	if result != 0:
 		print('Build failed!')
 		sys.exit(result)
 
-	emcc_version = subprocess.check_output('emcc --version | head -n 1', shell=True)
+	emcc_version = subprocess.check_output(['emcc', '--version'])
 	emcc_version = emcc_version.decode(sys.stdin.encoding)
-	emcc_version = emcc_version.strip()
+	emcc_version = emcc_version.splitlines()[0].strip()
 
 	# Now that the WASM modules have been built, patch our JS files
+	# Both modules are independent, patch them concurrently
 	encoder_wasm = os.path.join(install_dir, 'acl-encoder.wasm')
-	encoder_wasm_data = None
-	with open(encoder_wasm, 'rb') as f:
-		encoder_wasm_data = f.read()
-		(encoder_wasm_data, _) = codecs.getencoder('hex')(encoder_wasm_data)
-		encoder_wasm_data = encoder_wasm_data.decode('utf-8')
-
 	encoder_js = os.path.join(js_dir, 'src-js', 'encoder.wasm.js')
-	encoder_js_data = None
-	with open(encoder_js, 'r') as f:
-		encoder_js_data = f.read()
-		encoder_js_data = re.sub(r'^([ \t]*// Compiled with ).*$', r'\1{}'.format(emcc_version), encoder_js_data, flags = re.MULTILINE)
-		encoder_js_data = re.sub(r'^([ \t]*export const wasmBinaryBlob =) "[<>_\w\d]*"$', r'\1 "{}"'.format(encoder_wasm_data), encoder_js_data, flags = re.MULTILINE)
-
-	with open(encoder_js, 'w') as f:
-		f.write(encoder_js_data)
-
 	decoder_wasm = os.path.join(install_dir, 'acl-decoder.wasm')
-	decoder_wasm_data = None
-	with open(decoder_wasm, 'rb') as f:
-		decoder_wasm_data = f.read()
-		(decoder_wasm_data, _) = codecs.getencoder('hex')(decoder_wasm_data)
-		decoder_wasm_data = decoder_wasm_data.decode('utf-8')
-
 	decoder_js = os.path.join(js_dir, 'src-js', 'decoder.wasm.js')
-	decoder_js_data = None
-	with open(decoder_js, 'r') as f:
-		decoder_js_data = f.read()
-		decoder_js_data = re.sub(r'^([ \t]*// Compiled with ).*$', r'\1{}'.format(emcc_version), decoder_js_data, flags = re.MULTILINE)
-		decoder_js_data = re.sub(r'^([ \t]*export const wasmBinaryBlob =) "[<>_\w\d]*"$', r'\1 "{}"'.format(decoder_wasm_data), decoder_js_data, flags = re.MULTILINE)
+	encoder_stamp = os.path.join(build_dir, 'encoder.wasm.js.stamp')
+	decoder_stamp = os.path.join(build_dir, 'decoder.wasm.js.stamp')
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+		encoder_future = executor.submit(patch_wasm_module, encoder_wasm, encoder_js, encoder_stamp, emcc_version)
+		decoder_future = executor.submit(patch_wasm_module, decoder_wasm, decoder_js, decoder_stamp, emcc_version)
 
-	with open(decoder_js, 'w') as f:
-		f.write(decoder_js_data)
+		# Propagate any exception raised while patching
+		encoder_future.result()
+		decoder_future.result()
 
 def do_tests(args):
 	print('No unit tests specific to this library yet, contributions welcome!')
@@ -113,24 +190,21 @@ def do_pack(root_dir, js_dir, staging_dir, args):
 	print('Packaging NPM module ...')
 
 	# Clean our previous packing data
-	if os.path.exists(staging_dir):
+	try:
 		shutil.rmtree(staging_dir)
+	except FileNotFoundError:
+		pass
 
 	print('Copying acl-js ...')
-	shutil.copytree(js_dir, staging_dir)
+	# Skip what we don't need instead of copying and removing it afterwards
+	shutil.copytree(js_dir, staging_dir, ignore=shutil.ignore_patterns('src-encoder-cpp', 'src-decoder-cpp'))
 	shutil.copy(os.path.join(root_dir, 'CHANGELOG.md'), staging_dir)
 	shutil.copy(os.path.join(root_dir, 'README.md'), staging_dir)
 	shutil.copy(os.path.join(root_dir, 'LICENSE'), staging_dir)
 
-	print('Removing what we don\'t need ...')
-	encoder_dir = os.path.join(staging_dir, 'src-encoder-cpp')
-	shutil.rmtree(encoder_dir)
-	decoder_dir = os.path.join(staging_dir, 'src-decoder-cpp')
-	shutil.rmtree(decoder_dir)
-
 	print('Running npm pack ...')
 	os.chdir(staging_dir)
-	result = subprocess.call('npm pack', shell=True)
+	result = subprocess.call(['npm', 'pack'])
 	if result != 0:
 		print('Packing failed!')
 		sys.exit(result)
@@ -145,39 +219,52 @@ if __name__ == "__main__":
 	test_data_dir = os.path.join(root_dir, 'test_data')
 	staging_dir = os.path.join(root_dir, 'staging')
 
+	# Cleaning runs concurrently with the other steps, we wait for it before exiting
+	clean_executor = None
+	clean_futures = []
+	clean_failed = False
+
 	if args.clean:
 		print('Cleaning previous build ...')
-		if os.path.exists(build_dir):
-			shutil.rmtree(build_dir)
-		if os.path.exists(install_dir):
-			shutil.rmtree(install_dir)
+		clean_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+		clean_futures.extend(clean_dir(build_dir, clean_executor))
+		clean_futures.extend(clean_dir(install_dir, clean_executor))
+
+	try:
+		os.makedirs(build_dir, exist_ok=True)
+		os.makedirs(install_dir, exist_ok=True)
 
-	if not os.path.exists(build_dir):
-		os.makedirs(build_dir)
-	if not os.path.exists(install_dir):
-		os.makedirs(install_dir)
+		os.chdir(build_dir)
 
-	os.chdir(build_dir)
+		print('Using config: {}'.format(args.config))
+		print('Using {} threads'.format(args.num_threads))
 
-	print('Using config: {}'.format(args.config))
-	print('Using {} threads'.format(args.num_threads))
+		if args.pack:
+			# Always build when we pack to get latest
+			args.build = True
 
-	# Make sure 'make' runs with all available cores
-	os.environ['MAKEFLAGS'] = '-j{}'.format(args.num_threads)
+		do_generate_solution(install_dir, args)
 
-	if args.pack:
-		# Always build when we pack to get latest
-		args.build = True
+		if args.build:
+			do_build(build_dir, install_dir, js_dir, args)
 
-	do_generate_solution(install_dir, args)
+		if args.unit_test:
+			do_tests(args)
 
-	if args.build:
-		do_build(install_dir, js_dir, args)
+		if args.pack:
+			do_pack(root_dir, js_dir, staging_dir, args)
+	finally:
+		# Report any error raised while cleaning, even if one of the steps above failed
+		for future in clean_futures:
+			error = future.exception()
+			if error:
+				print('Failed to clean: {}'.format(error))
+				clean_failed = True
 
-	if args.unit_test:
-		do_tests(args)
+		if clean_executor:
+			clean_executor.shutdown()
 
-	if args.pack:
-		do_pack(root_dir, js_dir, staging_dir, args)
+	if clean_failed:
+		sys.exit(1)
 
 	sys.exit(0)